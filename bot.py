@@ -1,14 +1,16 @@
 import os
 import asyncio
 import logging
-from datetime import datetime, time
+from time import monotonic
+from datetime import datetime, time, timezone
 from typing import Optional, Dict, List
 import sys
 
 import pytz
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.types import Message, ContentType, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.filters import Command
+from aiogram.filters import Command, StateFilter
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -16,8 +18,11 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 
 import asyncpg
+import orjson
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.executors.asyncio import AsyncIOExecutor
 
 # Настройка логирования для Railway
 logging.basicConfig(
@@ -27,8 +32,63 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Создаем роутер
+def _json_dumps(obj) -> str:
+    """orjson-сериализация для web.json_response(dumps=...) и кодеков asyncpg"""
+    return orjson.dumps(obj).decode()
+
+# Создаем роутеры: stateless_router подключается первым и обслуживает
+# команды вне FSM-диалогов, не трогая хранилище состояний
 router = Router()
+stateless_router = Router()
+
+class TTLMemoryStorage(MemoryStorage):
+    """MemoryStorage с вытеснением брошенных FSM-состояний.
+
+    Обычный MemoryStorage держит состояние каждого чата вечно: если
+    пользователь бросил /newpost на полпути, его запись остаётся в памяти
+    навсегда. Здесь запоминаем время последнего обращения и периодически
+    (job в планировщике) выкидываем записи старше max_age.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._last_touch: Dict = {}
+
+    async def set_state(self, key, state=None):
+        self._last_touch[key] = monotonic()
+        await super().set_state(key, state=state)
+
+    async def set_data(self, key, data):
+        self._last_touch[key] = monotonic()
+        await super().set_data(key, data)
+
+    async def get_state(self, key):
+        # get_state вызывается FSM-мидлварью на каждый апдейт, и defaultdict
+        # внутри MemoryStorage создаёт запись даже для пользователей без
+        # диалога — отмечаем обращение, чтобы такие записи тоже вытеснялись
+        self._last_touch[key] = monotonic()
+        return await super().get_state(key)
+
+    async def get_data(self, key):
+        self._last_touch[key] = monotonic()
+        return await super().get_data(key)
+
+    async def evict_stale(self, max_age: float = 1800.0):
+        """Удаляем состояния, к которым не обращались дольше max_age секунд"""
+        deadline = monotonic() - max_age
+        stale = [key for key, touched in self._last_touch.items()
+                 if touched < deadline]
+        for key in stale:
+            self._last_touch.pop(key, None)
+            self.storage.pop(key, None)
+        # Страховка: записи, появившиеся в обход set_*/get_* (defaultdict),
+        # без отметки времени тоже не должны жить вечно
+        orphans = [key for key in self.storage if key not in self._last_touch]
+        for key in orphans:
+            self.storage.pop(key, None)
+        if stale or orphans:
+            logger.info("🧹 Вытеснено %d брошенных FSM-состояний",
+                        len(stale) + len(orphans))
 
 # Состояния для FSM
 class PostStates(StatesGroup):
@@ -39,6 +99,7 @@ class PostStates(StatesGroup):
 # Конфигурация из переменных окружения Railway
 BOT_TOKEN = os.getenv('BOT_TOKEN', 'YOUR_BOT_TOKEN_HERE')
 ADMIN_IDS = list(map(int, os.getenv('ADMIN_IDS', '123456789').split(',')))
+ADMIN_IDS_SET = frozenset(ADMIN_IDS)  # O(1) проверка админа на горячем пути
 DEFAULT_TIMEZONE = os.getenv('TIMEZONE', 'Europe/Moscow')
 DATABASE_URL = os.getenv('DATABASE_URL')
 
@@ -50,187 +111,288 @@ pool: Optional[asyncpg.Pool] = None
 
 # ========== DATABASE FUNCTIONS (для PostgreSQL на Railway) ==========
 
+# SQL горячих запросов выносим в константы: asyncpg кэширует подготовленные
+# стейтменты по тексту запроса, поэтому текст должен быть байт-в-байт одинаковым
+# UPSERT и чтение профиля одним запросом: RETURNING отдаёт поля тарифа
+# сразу, без последующего SELECT
+SQL_UPSERT_USER = '''
+    INSERT INTO users (id, username, full_name, tariff, is_admin)
+    VALUES ($1, $2, $3, 'free', $4)
+    ON CONFLICT (id) DO UPDATE
+    SET username = EXCLUDED.username,
+        full_name = EXCLUDED.full_name
+    RETURNING tariff, channels_limit, posts_per_day
+'''
+
+SQL_USER_CHANNELS = '''
+    SELECT channel_id, channel_username, channel_title
+    FROM channels
+    WHERE user_id = $1 AND is_active = TRUE
+    ORDER BY added_at
+'''
+
+SQL_USER_INFO = 'SELECT * FROM users WHERE id = $1'
+
+SQL_TARIFFS = 'SELECT * FROM tariffs ORDER BY price_usd'
+
+# Тариф и счётчик постов за сегодня одним запросом (один round-trip на /newpost)
+SQL_NEWPOST_CONTEXT = '''
+    SELECT COALESCE(t.posts_per_day, u.posts_per_day) AS posts_per_day,
+           COALESCE(t.channels_limit, u.channels_limit) AS channels_limit,
+           u.tariff,
+           (SELECT COUNT(*) FROM scheduled_posts
+            WHERE user_id = $1
+            AND created_at >= date_trunc('day', now())
+            AND status IN ('scheduled', 'published')) AS posts_today
+    FROM users u
+    LEFT JOIN tariffs t ON u.tariff = t.name
+    WHERE u.id = $1
+'''
+
+async def _setup_connection(conn):
+    """Хук инициализации соединения: кодеки и сессионные настройки"""
+    # text-формат: бинарный jsonb требует префиксного байта версии
+    await conn.set_type_codec(
+        'json',
+        encoder=_json_dumps, decoder=orjson.loads,
+        schema='pg_catalog', format='text'
+    )
+    await conn.set_type_codec(
+        'jsonb',
+        encoder=_json_dumps, decoder=orjson.loads,
+        schema='pg_catalog', format='text'
+    )
+    # NUMERIC → float вместо decimal.Decimal: цены тарифов нужны только
+    # для отображения, а декодер Decimal заметно дороже
+    await conn.set_type_codec(
+        'numeric',
+        encoder=str, decoder=float,
+        schema='pg_catalog', format='text'
+    )
+    # Фиксируем таймзону сессии один раз, а не полагаемся на дефолт сервера
+    await conn.execute("SET TIME ZONE 'UTC'")
+
+# Конфигурацию пула собираем один раз при импорте: при реконнектах
+# create_db_pool не должен пересобирать её заново.
+# asyncpg сам разбирает DSN от Railway; пул по правилу (cores*2)+1 —
+# для одного процесса бота 20 коннектов только тратят RAM на Postgres
+_DB_POOL_CONFIG = {
+    'dsn': DATABASE_URL,
+    'ssl': 'require',  # Railway требует SSL
+    'min_size': 2,
+    'max_size': max(4, (os.cpu_count() or 1) * 2 + 1),
+    'max_inactive_connection_lifetime': 300.0,
+    'max_queries': 50000,
+    'command_timeout': 10.0,  # зависший запрос не должен исчерпать пул
+    'statement_cache_size': 1024,
+    'max_cacheable_statement_size': 0,  # не обрезать длинные запросы из кэша
+}
+
 async def create_db_pool():
     """Создаем пул подключений к PostgreSQL на Railway"""
     if not DATABASE_URL:
         logger.error("DATABASE_URL не установлен!")
         raise ValueError("DATABASE_URL не установлен в переменных окружения")
-    
-    # Парсим DATABASE_URL от Railway
-    import urllib.parse
-    parsed = urllib.parse.urlparse(DATABASE_URL)
-    
-    db_config = {
-        'user': parsed.username,
-        'password': parsed.password,
-        'database': parsed.path[1:],
-        'host': parsed.hostname,
-        'port': parsed.port or 5432,
-        'ssl': 'require'  # Railway требует SSL
-    }
-    
-    logger.info(f"Подключаемся к БД: {db_config['host']}:{db_config['port']}")
-    
-    return await asyncpg.create_pool(
-        **db_config,
-        min_size=5,
-        max_size=20,
-        ssl='require'
-    )
+
+    logger.info("Подключаемся к БД...")
+    return await asyncpg.create_pool(**_DB_POOL_CONFIG, setup=_setup_connection)
+
+# Вся схема одной пачкой: asyncpg выполняет multi-statement текст одним
+# round-trip (simple query protocol), вместо шести отдельных execute
+SQL_INIT_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS users (
+        id BIGINT PRIMARY KEY,
+        username TEXT,
+        full_name TEXT,
+        created_at TIMESTAMP DEFAULT NOW(),
+        tariff TEXT DEFAULT 'free',
+        channels_limit INTEGER DEFAULT 1,
+        posts_per_day INTEGER DEFAULT 3,
+        is_admin BOOLEAN DEFAULT FALSE
+    );
+
+    CREATE TABLE IF NOT EXISTS channels (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT,
+        channel_id BIGINT,
+        channel_username TEXT,
+        channel_title TEXT,
+        added_at TIMESTAMP DEFAULT NOW(),
+        is_active BOOLEAN DEFAULT TRUE,
+        FOREIGN KEY (user_id) REFERENCES users(id),
+        UNIQUE(channel_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS scheduled_posts (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT,
+        channel_id BIGINT,
+        message_text TEXT,
+        media_path TEXT,
+        media_file_id TEXT,
+        media_type TEXT,
+        scheduled_time TIMESTAMP,
+        status TEXT DEFAULT 'scheduled',
+        created_at TIMESTAMP DEFAULT NOW(),
+        published_at TIMESTAMP,
+        error_message TEXT,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    );
+
+    CREATE TABLE IF NOT EXISTS tariffs (
+        id SERIAL PRIMARY KEY,
+        name TEXT UNIQUE,
+        price_usd DECIMAL(10,2),
+        channels_limit INTEGER,
+        posts_per_day INTEGER,
+        description TEXT
+    );
+
+    -- Индексы под горячие выборки: счётчик постов за день и активные каналы
+    CREATE INDEX IF NOT EXISTS ix_posts_user_day
+    ON scheduled_posts (user_id, created_at)
+    WHERE status IN ('scheduled', 'published');
+
+    CREATE INDEX IF NOT EXISTS ix_channels_user_active
+    ON channels (user_id)
+    WHERE is_active = TRUE;
+
+    -- Для баз, созданных до появления media_file_id
+    ALTER TABLE scheduled_posts ADD COLUMN IF NOT EXISTS media_file_id TEXT;
+
+    -- Наполняем тарифы если пусто (без отдельного COUNT-запроса)
+    INSERT INTO tariffs (name, price_usd, channels_limit, posts_per_day, description)
+    SELECT * FROM (VALUES
+        ('free', 0::DECIMAL(10,2), 1, 3, 'Бесплатный тариф'),
+        ('standard', 5::DECIMAL(10,2), 2, 6, 'Стандартный тариф: 2 канала, 6 постов в день'),
+        ('vip', 8::DECIMAL(10,2), 3, 12, 'VIP тариф: 3 канала, 12 постов в день')
+    ) AS seed(name, price_usd, channels_limit, posts_per_day, description)
+    WHERE NOT EXISTS (SELECT 1 FROM tariffs);
+'''
 
 async def init_database():
     """Инициализируем таблицы в базе данных"""
     async with pool.acquire() as conn:
-        # Таблица пользователей
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id BIGINT PRIMARY KEY,
-                username TEXT,
-                full_name TEXT,
-                created_at TIMESTAMP DEFAULT NOW(),
-                tariff TEXT DEFAULT 'free',
-                channels_limit INTEGER DEFAULT 1,
-                posts_per_day INTEGER DEFAULT 3,
-                is_admin BOOLEAN DEFAULT FALSE
-            )
-        ''')
-        
-        # Таблица каналов
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS channels (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                channel_id BIGINT,
-                channel_username TEXT,
-                channel_title TEXT,
-                added_at TIMESTAMP DEFAULT NOW(),
-                is_active BOOLEAN DEFAULT TRUE,
-                FOREIGN KEY (user_id) REFERENCES users(id),
-                UNIQUE(channel_id)
-            )
-        ''')
-        
-        # Таблица запланированных постов
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS scheduled_posts (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                channel_id BIGINT,
-                message_text TEXT,
-                media_path TEXT,
-                media_type TEXT,
-                scheduled_time TIMESTAMP,
-                status TEXT DEFAULT 'scheduled',
-                created_at TIMESTAMP DEFAULT NOW(),
-                published_at TIMESTAMP,
-                error_message TEXT,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        ''')
-        
-        # Таблица тарифов
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS tariffs (
-                id SERIAL PRIMARY KEY,
-                name TEXT UNIQUE,
-                price_usd DECIMAL(10,2),
-                channels_limit INTEGER,
-                posts_per_day INTEGER,
-                description TEXT
-            )
-        ''')
-        
-        # Наполняем тарифы если пусто
-        tariffs_count = await conn.fetchval('SELECT COUNT(*) FROM tariffs')
-        if tariffs_count == 0:
-            await conn.execute('''
-                INSERT INTO tariffs (name, price_usd, channels_limit, posts_per_day, description) 
-                VALUES 
-                ('free', 0, 1, 3, 'Бесплатный тариф'),
-                ('standard', 5, 2, 6, 'Стандартный тариф: 2 канала, 6 постов в день'),
-                ('vip', 8, 3, 12, 'VIP тариф: 3 канала, 12 постов в день')
-            ''')
-        
+        async with conn.transaction():
+            await conn.execute(SQL_INIT_SCHEMA)
+
         logger.info("✅ Таблицы в БД инициализированы")
 
-async def add_user(user_id: int, username: str, full_name: str):
-    """Добавляем пользователя в БД"""
-    async with pool.acquire() as conn:
-        await conn.execute('''
-            INSERT INTO users (id, username, full_name, tariff, is_admin)
-            VALUES ($1, $2, $3, 'free', $4)
-            ON CONFLICT (id) DO UPDATE 
-            SET username = EXCLUDED.username,
-                full_name = EXCLUDED.full_name
-        ''', user_id, username, full_name, user_id in ADMIN_IDS)
-
-async def get_user_channels(user_id: int) -> List[Dict]:
-    """Получаем активные каналы пользователя"""
-    async with pool.acquire() as conn:
-        rows = await conn.fetch('''
-            SELECT channel_id, channel_username, channel_title 
-            FROM channels 
-            WHERE user_id = $1 AND is_active = TRUE
-            ORDER BY added_at
-        ''', user_id)
-        return [dict(row) for row in rows]
+async def upsert_and_get_user(user_id: int, username: str, full_name: str,
+                              is_admin: bool) -> Dict:
+    """Добавляем/обновляем пользователя и возвращаем его тариф одним запросом"""
+    row = await pool.fetchrow(SQL_UPSERT_USER, user_id, username, full_name,
+                              is_admin)
+    user_info = dict(row)
+    tariffs_by_name = {t['name']: t for t in await get_tariffs()}
+    tariff = tariffs_by_name.get(user_info['tariff'])
+    if tariff:
+        user_info.update((k, v) for k, v in tariff.items() if k != 'id')
+    return user_info
+
+async def get_user_channels(user_id: int) -> List[asyncpg.Record]:
+    """Получаем активные каналы пользователя.
+
+    Record поддерживает доступ по ключу как dict, поэтому строки отдаём
+    как есть, без аллокации словаря на каждую запись.
+    """
+    return await pool.fetch(SQL_USER_CHANNELS, user_id)
+
+# Тарифы меняются практически никогда — держим их в памяти с TTL,
+# чтобы не ходить в Postgres на каждый /tariffs и /start
+_TARIFFS_CACHE = {"data": None, "expires": 0.0}
+_TARIFFS_TTL = 300.0
+
+async def get_tariffs() -> List[Dict]:
+    """Список тарифов из кэша (TTL 5 минут) или из БД"""
+    if _TARIFFS_CACHE["data"] is not None and monotonic() < _TARIFFS_CACHE["expires"]:
+        return _TARIFFS_CACHE["data"]
+
+    rows = await pool.fetch(SQL_TARIFFS)
+    _TARIFFS_CACHE["data"] = [dict(row) for row in rows]
+    _TARIFFS_CACHE["expires"] = monotonic() + _TARIFFS_TTL
+    return _TARIFFS_CACHE["data"]
 
 async def get_user_info(user_id: int) -> Dict:
     """Получаем информацию о пользователе и его тарифе"""
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow('''
-            SELECT u.*, t.*
-            FROM users u
-            LEFT JOIN tariffs t ON u.tariff = t.name
-            WHERE u.id = $1
-        ''', user_id)
-        return dict(row) if row else None
+    row = await pool.fetchrow(SQL_USER_INFO, user_id)
+    if not row:
+        return None
+
+    # Вместо JOIN с tariffs накладываем тариф из кэша поверх полей пользователя
+    user_info = dict(row)
+    tariffs_by_name = {t['name']: t for t in await get_tariffs()}
+    tariff = tariffs_by_name.get(user_info['tariff'])
+    if tariff:
+        user_info.update((k, v) for k, v in tariff.items() if k != 'id')
+    return user_info
+
+async def get_newpost_context(user_id: int) -> Optional[Dict]:
+    """Лимиты тарифа и число постов за сегодня одним запросом"""
+    row = await pool.fetchrow(SQL_NEWPOST_CONTEXT, user_id)
+    return dict(row) if row else None
 
 # ========== COMMAND HANDLERS ==========
 
-@router.message(Command("start"))
+# Статические части /start собираем один раз при импорте, в обработчике
+# остаётся только %-подстановка динамических полей
+_ADMIN_MSG_TMPL = (
+    "👑 <b>Привет, админ!</b>\n\n"
+    "📊 <b>Доступные команды:</b>\n"
+    "/newpost - создать новый пост\n"
+    "/mychannels - мои каналы\n"
+    "/addchannel - добавить канал\n"
+    "/schedule - запланированные посты\n"
+    "/stats - статистика\n"
+    "/users - список пользователей\n\n"
+    "💎 <b>Ваш тариф:</b> %s"
+)
+
+_USER_TARIFF_TMPL = (
+    "\n💎 <b>Ваш тариф:</b> %s\n"
+    "📢 <b>Каналов можно добавить:</b> %s\n"
+    "📝 <b>Постов в день:</b> %s\n        "
+)
+
+_USER_MSG_TMPL = (
+    "🤖 <b>Привет, %s!</b>\n"
+    "Я бот для автоматической публикации постов в Telegram каналы.\n\n"
+    "%s\n"
+    "<b>Доступные команды:</b>\n"
+    "/newpost - создать и запланировать пост\n"
+    "/mychannels - мои каналы\n"
+    "/schedule - запланированные посты\n"
+    "/tariffs - посмотреть тарифы\n"
+    "/help - помощь\n\n"
+    "<i>Используйте кнопки меню для удобства!</i>"
+)
+
+@stateless_router.message(Command("start"), StateFilter(None))
 async def cmd_start(message: Message):
     """Обработчик команды /start"""
-    await add_user(message.from_user.id, 
-                  message.from_user.username or "", 
-                  message.from_user.full_name or "")
-    
-    user_info = await get_user_info(message.from_user.id)
-    
-    if message.from_user.id in ADMIN_IDS:
+    is_admin = message.from_user.id in ADMIN_IDS_SET
+    user_info = await upsert_and_get_user(message.from_user.id,
+                                          message.from_user.username or "",
+                                          message.from_user.full_name or "",
+                                          is_admin)
+
+    if is_admin:
         await message.answer(
-            "👑 <b>Привет, админ!</b>\n\n"
-            "📊 <b>Доступные команды:</b>\n"
-            "/newpost - создать новый пост\n"
-            "/mychannels - мои каналы\n"
-            "/addchannel - добавить канал\n"
-            "/schedule - запланированные посты\n"
-            "/stats - статистика\n"
-            "/users - список пользователей\n\n"
-            f"💎 <b>Ваш тариф:</b> {user_info['tariff'].upper() if user_info else 'FREE'}"
+            _ADMIN_MSG_TMPL % (user_info['tariff'].upper() if user_info else 'FREE')
         )
     else:
-        tariff_info = f"""
-💎 <b>Ваш тариф:</b> {user_info['tariff'].upper() if user_info else 'FREE'}
-📢 <b>Каналов можно добавить:</b> {user_info['channels_limit'] if user_info else 1}
-📝 <b>Постов в день:</b> {user_info['posts_per_day'] if user_info else 3}
-        """ if user_info else ""
-        
+        tariff_info = _USER_TARIFF_TMPL % (
+            user_info['tariff'].upper(),
+            user_info['channels_limit'],
+            user_info['posts_per_day'],
+        ) if user_info else ""
+
         await message.answer(
-            f"🤖 <b>Привет, {message.from_user.first_name}!</b>\n"
-            f"Я бот для автоматической публикации постов в Telegram каналы.\n\n"
-            f"{tariff_info}\n"
-            "<b>Доступные команды:</b>\n"
-            "/newpost - создать и запланировать пост\n"
-            "/mychannels - мои каналы\n"
-            "/schedule - запланированные посты\n"
-            "/tariffs - посмотреть тарифы\n"
-            "/help - помощь\n\n"
-            "<i>Используйте кнопки меню для удобства!</i>",
+            _USER_MSG_TMPL % (message.from_user.first_name, tariff_info),
             parse_mode=ParseMode.HTML
         )
 
-@router.message(Command("help"))
+@stateless_router.message(Command("help"), StateFilter(None))
 async def cmd_help(message: Message):
     """Помощь по командам"""
     help_text = """
@@ -262,11 +424,10 @@ async def cmd_help(message: Message):
     """
     await message.answer(help_text, parse_mode=ParseMode.HTML)
 
-@router.message(Command("tariffs"))
+@stateless_router.message(Command("tariffs"), StateFilter(None))
 async def cmd_tariffs(message: Message):
     """Показывает доступные тарифы"""
-    async with pool.acquire() as conn:
-        tariffs = await conn.fetch('SELECT * FROM tariffs ORDER BY price_usd')
+    tariffs = await get_tariffs()
     
     tariffs_text = "<b>💎 Доступные тарифы:</b>\n\n"
     
@@ -290,29 +451,21 @@ async def cmd_tariffs(message: Message):
 @router.message(Command("newpost"))
 async def cmd_newpost(message: Message, state: FSMContext):
     """Начинаем создание нового поста"""
-    user_info = await get_user_info(message.from_user.id)
-    if not user_info:
+    ctx = await get_newpost_context(message.from_user.id)
+    if not ctx:
         await message.answer("❌ Ошибка! Сначала используйте /start")
         return
-    
+
     # Проверяем лимиты
-    async with pool.acquire() as conn:
-        posts_today = await conn.fetchval('''
-            SELECT COUNT(*) FROM scheduled_posts 
-            WHERE user_id = $1 
-            AND DATE(created_at) = CURRENT_DATE
-            AND status IN ('scheduled', 'published')
-        ''', message.from_user.id)
-        
-        if posts_today >= user_info['posts_per_day']:
-            await message.answer(
-                f"❌ <b>Лимит постов исчерпан!</b>\n"
-                f"Ваш лимит: {user_info['posts_per_day']} в день\n"
-                f"Использовано сегодня: {posts_today}\n\n"
-                f"Хотите больше постов? Посмотрите тарифы /tariffs",
-                parse_mode=ParseMode.HTML
-            )
-            return
+    if ctx['posts_today'] >= ctx['posts_per_day']:
+        await message.answer(
+            f"❌ <b>Лимит постов исчерпан!</b>\n"
+            f"Ваш лимит: {ctx['posts_per_day']} в день\n"
+            f"Использовано сегодня: {ctx['posts_today']}\n\n"
+            f"Хотите больше постов? Посмотрите тарифы /tariffs",
+            parse_mode=ParseMode.HTML
+        )
+        return
     
     await message.answer(
         "📝 <b>Создание нового поста</b>\n\n"
@@ -320,43 +473,289 @@ async def cmd_newpost(message: Message, state: FSMContext):
         "• Текст поста\n"
         "• Фото/видео с подписью\n"
         "• Или несколько сообщений с контентом\n\n"
-        "<i>Когда закончите, отправьте команду /done</i>\n"
+        "<i>Когда закончите, сделайте паузу — я соберу пост сам</i>\n"
         "<i>Для отмены отправьте /cancel</i>",
         parse_mode=ParseMode.HTML
     )
     await state.set_state(PostStates.waiting_for_content)
-    await state.update_data(media_path=None, media_type=None, text="")
+    await state.update_data(chunks=[], media_path=None, media_file_id=None,
+                            media_type=None, text="")
+
+# Дебаунс сборки поста: каждое новое сообщение сдвигает таймер, флаш
+# срабатывает один раз после паузы вместо опроса очереди
+_FLUSH_DELAY = 5.0
+_FLUSH_TIMERS: Dict[int, asyncio.TimerHandle] = {}
+# Сильные ссылки на задачи флаша: как и у health-тикера, event loop держит
+# задачи слабо, и собранная GC задача оставила бы диалог висеть без ответа
+_FLUSH_TASKS: Dict[int, asyncio.Task] = {}
+
+def _start_flush_task(message: Message, state: FSMContext):
+    """Запускаем флаш по таймеру, удерживая ссылку на задачу"""
+    user_id = message.from_user.id
+    task = asyncio.create_task(_flush_content(message, state))
+    _FLUSH_TASKS[user_id] = task
+    task.add_done_callback(lambda _: _FLUSH_TASKS.pop(user_id, None))
+
+async def _flush_content(message: Message, state: FSMContext):
+    """Собираем накопленные сообщения в один пост после паузы"""
+    _FLUSH_TIMERS.pop(message.from_user.id, None)
+
+    data = await state.get_data()
+    chunks = data.get('chunks') or []
+    if not chunks:
+        return
+
+    text_parts = []
+    media_file_id = None
+    media_type = None
+    for chunk in chunks:
+        if chunk.get('text'):
+            text_parts.append(chunk['text'])
+        if chunk.get('media_file_id'):
+            media_file_id = chunk['media_file_id']
+            media_type = chunk['media_type']
+
+    await state.update_data(chunks=[], text="\n".join(text_parts),
+                            media_file_id=media_file_id,
+                            media_type=media_type)
+    await state.set_state(PostStates.waiting_for_time)
+
+    await message.answer(
+        "✅ <b>Контент принят!</b>\n\n"
+        "Теперь отправьте время публикации в формате ЧЧ:ММ "
+        "или ДД.ММ ЧЧ:ММ",
+        parse_mode=ParseMode.HTML
+    )
 
-# ... (остальные обработчики из предыдущего кода остаются аналогичными, 
+@router.message(Command("cancel"), StateFilter(PostStates))
+async def cmd_cancel(message: Message, state: FSMContext):
+    """Отменяем создание поста на любом шаге диалога"""
+    timer = _FLUSH_TIMERS.pop(message.from_user.id, None)
+    if timer:
+        timer.cancel()
+    task = _FLUSH_TASKS.pop(message.from_user.id, None)
+    if task:
+        task.cancel()
+    await state.clear()
+    await message.answer("❌ Создание поста отменено")
+
+@router.message(PostStates.waiting_for_content)
+async def process_content(message: Message, state: FSMContext):
+    """Собираем контент поста от пользователя"""
+    # Прочие команды контентом поста не считаем
+    if message.text and message.text.startswith('/'):
+        return
+
+    chunk = {}
+
+    if message.photo:
+        # file_id уже загруженного медиа: при публикации отдаём его Telegram
+        # вместо повторной загрузки файла с диска
+        chunk['media_file_id'] = message.photo[-1].file_id
+        chunk['media_type'] = 'photo'
+        if message.caption:
+            chunk['text'] = message.caption
+    elif message.video:
+        chunk['media_file_id'] = message.video.file_id
+        chunk['media_type'] = 'video'
+        if message.caption:
+            chunk['text'] = message.caption
+    elif message.text:
+        chunk['text'] = message.text
+
+    if chunk:
+        data = await state.get_data()
+        chunks = data.get('chunks') or []
+        chunks.append(chunk)
+        await state.update_data(chunks=chunks)
+
+    # Перезаводим таймер: флаш случится через _FLUSH_DELAY секунд тишины
+    prev = _FLUSH_TIMERS.pop(message.from_user.id, None)
+    if prev:
+        prev.cancel()
+    loop = asyncio.get_running_loop()
+    _FLUSH_TIMERS[message.from_user.id] = loop.call_later(
+        _FLUSH_DELAY, _start_flush_task, message, state
+    )
+
+# ... (остальные обработчики из предыдущего кода остаются аналогичными,
 # но с улучшенным логированием для Railway)
 
+# ========== SCHEDULED PUBLISHING ==========
+
+SQL_DUE_POSTS = '''
+    SELECT id, user_id, channel_id, message_text, media_path, media_file_id,
+           media_type, scheduled_time
+    FROM scheduled_posts
+    WHERE status = 'scheduled' AND scheduled_time > now()
+'''
+
+# Глобальный лимит Telegram ~30 сообщений/сек; семафор держит общий темп
+# отправки чуть ниже, сколько бы задач публикации ни сработало одновременно
+_TG_SEM = asyncio.Semaphore(25)
+
+async def _send_post_media(channel_id: int, post: Dict, media):
+    """Отправляем медиа поста (file_id или файл с диска)"""
+    if post.get('media_type') == 'photo':
+        await bot.send_photo(channel_id, media,
+                             caption=post['message_text'] or None)
+    else:
+        await bot.send_video(channel_id, media,
+                             caption=post['message_text'] or None)
+
+async def _send_one(channel_id: int, post: Dict):
+    """Отправляем пост в один канал под глобальным рейт-лимитом"""
+    async with _TG_SEM:
+        if post.get('media_file_id') or post.get('media_path'):
+            # file_id уже лежит на серверах Telegram — повторной загрузки нет;
+            # файл с диска остаётся запасным вариантом
+            if post.get('media_file_id'):
+                try:
+                    await _send_post_media(channel_id, post,
+                                           post['media_file_id'])
+                # Падать на диск только если Telegram отверг сам file_id;
+                # flood-wait и сетевые ошибки повторной загрузкой не лечатся
+                except TelegramBadRequest:
+                    if not post.get('media_path'):
+                        raise
+                    logger.warning("⚠️ Telegram отверг file_id поста %s, "
+                                   "загружаем с диска", post['id'])
+                    await _send_post_media(channel_id, post,
+                                           FSInputFile(post['media_path']))
+            else:
+                await _send_post_media(channel_id, post,
+                                       FSInputFile(post['media_path']))
+        else:
+            await bot.send_message(channel_id, post['message_text'])
+
+async def publish_scheduled_post(post: Dict):
+    """Публикуем запланированный пост; NULL channel_id = во все каналы"""
+    if post.get('channel_id'):
+        channels = [post['channel_id']]
+    else:
+        channels = [ch['channel_id']
+                    for ch in await get_user_channels(post['user_id'])]
+
+    if not channels:
+        # Без каналов gather вернул бы пустой результат и пост ошибочно
+        # пометился бы опубликованным
+        await pool.execute('''
+            UPDATE scheduled_posts
+            SET status = 'error', error_message = $2
+            WHERE id = $1
+        ''', post['id'], 'Нет активных каналов для публикации')
+        logger.error("❌ Пост %s не опубликован: у пользователя %s нет "
+                     "активных каналов", post['id'], post['user_id'])
+        return
+
+    # Каналы отправляем конкурентно: публикация упирается в сеть,
+    # а рейт-лимит обеспечивает семафор внутри _send_one
+    results = await asyncio.gather(
+        *[_send_one(ch, post) for ch in channels],
+        return_exceptions=True
+    )
+
+    errors = []
+    for channel_id, result in zip(channels, results):
+        if isinstance(result, Exception):
+            errors.append(result)
+            logger.error("❌ Ошибка публикации поста %s в канал %s: %s",
+                         post['id'], channel_id, result)
+
+    if errors and len(errors) == len(channels):
+        await pool.execute('''
+            UPDATE scheduled_posts
+            SET status = 'error', error_message = $2
+            WHERE id = $1
+        ''', post['id'], str(errors[0]))
+    else:
+        await pool.execute('''
+            UPDATE scheduled_posts
+            SET status = 'published', published_at = NOW()
+            WHERE id = $1
+        ''', post['id'])
+        logger.info("✅ Пост %s опубликован (%d/%d каналов)",
+                    post['id'], len(channels) - len(errors), len(channels))
+
+async def reschedule_existing_posts():
+    """Восстанавливаем задачи публикации после рестарта.
+
+    Все будущие посты забираем одним запросом и добавляем в планировщик
+    между pause()/resume(), чтобы он не пересчитывал расписание на каждый
+    add_job.
+    """
+    rows = await pool.fetch(SQL_DUE_POSTS)
+    if not rows:
+        logger.info("📭 Нет запланированных постов для восстановления")
+        return
+
+    scheduler.pause()
+    try:
+        for r in rows:
+            scheduler.add_job(
+                publish_scheduled_post, 'date',
+                # scheduled_time хранится наивным UTC (сессии закреплены на
+                # UTC) — без явной tz apscheduler счёл бы его московским
+                run_date=r['scheduled_time'].replace(tzinfo=timezone.utc),
+                args=[dict(r)],
+                id=f"post_{r['id']}",
+                replace_existing=True,
+                misfire_grace_time=60,
+                coalesce=True
+            )
+    finally:
+        scheduler.resume()
+
+    logger.info("🔁 Восстановлено %d запланированных постов", len(rows))
+
 # ========== WEB SERVER FOR RAILWAY ==========
 
 from aiohttp import web
 
+# Railway дёргает health-check ~раз в секунду: тело ответа пересобирает
+# фоновый тикер с частотой 1 Гц, обработчику остаётся отдать готовые байты
+_HEALTH_PAYLOAD = {
+    "status": "ok",
+    "service": "telegram-post-bot",
+    "timestamp": ""
+}
+_HEALTH_BODY = orjson.dumps(_HEALTH_PAYLOAD)
+
+# Сильная ссылка на тикер: event loop держит задачи только слабыми
+# ссылками, без неё задача может быть собрана GC и timestamp замёрзнет
+_health_ticker_task: Optional[asyncio.Task] = None
+
+async def _refresh_health_body():
+    """Раз в секунду обновляем timestamp в кэшированном теле health-check"""
+    global _HEALTH_BODY
+    while True:
+        _HEALTH_PAYLOAD["timestamp"] = datetime.now(timezone.utc).isoformat()
+        _HEALTH_BODY = orjson.dumps(_HEALTH_PAYLOAD)
+        await asyncio.sleep(1)
+
 async def health_check(request):
     """Health check endpoint для Railway"""
-    return web.json_response({
-        "status": "ok",
-        "service": "telegram-post-bot",
-        "timestamp": datetime.now().isoformat()
-    })
+    return web.Response(body=_HEALTH_BODY, content_type="application/json")
 
 async def start_web_server():
     """Запускаем простой веб-сервер для Railway"""
     app = web.Application()
     app.router.add_get('/', health_check)
     app.router.add_get('/health', health_check)
-    
-    runner = web.AppRunner(app)
+
+    # access_log=None: не форматировать строку лога на каждый health-пинг
+    runner = web.AppRunner(app, access_log=None)
     await runner.setup()
     
     # Railway предоставляет PORT переменную окружения
     port = int(os.getenv('PORT', 8080))
     site = web.TCPSite(runner, '0.0.0.0', port)
     await site.start()
+
+    global _health_ticker_task
+    _health_ticker_task = asyncio.create_task(_refresh_health_body())
     
-    logger.info(f"🌐 Веб-сервер запущен на порту {port}")
+    logger.info("🌐 Веб-сервер запущен на порту %s", port)
     return runner
 
 # ========== MAIN FUNCTIONS ==========
@@ -372,8 +771,22 @@ async def on_startup():
     
     # Инициализируем планировщик
     global scheduler
-    scheduler = AsyncIOScheduler(timezone=DEFAULT_TIMEZONE)
+    # MemoryJobStore: источник правды — строки scheduled_posts в Postgres,
+    # поэтому персистентный jobstore дал бы лишнюю запись на каждый add_job
+    scheduler = AsyncIOScheduler(
+        timezone=DEFAULT_TIMEZONE,
+        jobstores={'default': MemoryJobStore()},
+        executors={'default': AsyncIOExecutor()},
+        job_defaults={
+            'coalesce': True,
+            'max_instances': 1,
+            'misfire_grace_time': 300,
+        }
+    )
     scheduler.start()
+
+    # Чистим брошенные FSM-состояния, чтобы память не росла бесконечно
+    scheduler.add_job(dp.storage.evict_stale, 'interval', minutes=5)
     
     # Инициализируем БД
     global pool
@@ -382,7 +795,7 @@ async def on_startup():
         await init_database()
         logger.info("✅ База данных подключена")
     except Exception as e:
-        logger.error(f"❌ Ошибка подключения к БД: {e}")
+        logger.error("❌ Ошибка подключения к БД: %s", e)
         raise
     
     # Перепланируем существующие посты
@@ -421,7 +834,8 @@ async def main():
     
     # Инициализируем бота
     bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    dp = Dispatcher(storage=MemoryStorage())
+    dp = Dispatcher(storage=TTLMemoryStorage())
+    dp.include_router(stateless_router)
     dp.include_router(router)
     
     # Регистрируем обработчики старта/остановки
@@ -437,14 +851,24 @@ async def main():
         await dp.start_polling(bot)
     finally:
         # Очистка при завершении
+        if _health_ticker_task:
+            _health_ticker_task.cancel()
         await web_runner.cleanup()
 
 if __name__ == "__main__":
+    # uvloop заметно быстрее стандартного цикла на socket I/O;
+    # на платформах без него (Windows) просто остаёмся на asyncio
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     # Для Railway важно обрабатывать KeyboardInterrupt
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("👋 Бот остановлен пользователем")
     except Exception as e:
-        logger.error(f"💥 Критическая ошибка: {e}")
+        logger.error("💥 Критическая ошибка: %s", e)
         sys.exit(1)